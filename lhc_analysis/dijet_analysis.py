@@ -12,9 +12,13 @@ Author: UnifiedTheoryPredictions
 Repository: https://github.com/UnifiedTheoryPredictions/unified-theory-experimental
 """
 
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
+from numba import njit
+from scipy.optimize import least_squares
 from scipy.stats import poisson, norm
 import warnings
 warnings.filterwarnings('ignore')
@@ -56,10 +60,32 @@ PREDICTIONS = {
     "M_kappa": {"center": 3100.0, "uncertainty": 300.0, "type": "tensor"}  # GeV
 }
 
+# Same predictions as a structured array, for vectorised analysis code;
+# string fields are sized from the data so no name or type is truncated
+PREDICTIONS_ARR = np.array(
+    [(name, pred["center"], pred["uncertainty"], pred["type"])
+     for name, pred in PREDICTIONS.items()],
+    dtype=[("name", f"U{max(map(len, PREDICTIONS))}"),
+           ("center", "f8"), ("uncertainty", "f8"),
+           ("type", f"U{max(len(pred['type']) for pred in PREDICTIONS.values())}")])
+
+@lru_cache(maxsize=8)
+def _mass_grid(num_points):
+    """Uniform 1.5-4.0 TeV dijet mass grid, cached per size and read-only."""
+    grid = np.linspace(1500, 4000, num_points)
+    grid.flags.writeable = False
+    return grid
+
+def _nearest_index(x0, dx, target, n):
+    """Index of the point nearest to `target` on the uniform grid x0 + i*dx."""
+    i = int(round((target - x0) / dx))
+    return 0 if i < 0 else (n - 1 if i >= n else i)
+
 # ============================================================================
 # MATHEMATICAL MODELS
 # ============================================================================
 
+@njit(fastmath=True, cache=True, error_model='numpy')
 def background_model(mass, a, b, c):
     """
     Smooth background model for dijet mass spectrum.
@@ -75,8 +101,10 @@ def background_model(mass, a, b, c):
     --------
     background : array_like
     """
-    return a * np.exp(-b * mass) + c * mass**(-3.5)
+    # Exponent is capped so a trial step in b cannot overflow to inf/NaN
+    return a * np.exp(-np.minimum(b * mass, 50.0)) + c * mass**(-3.5)
 
+@njit(fastmath=True, cache=True, error_model='numpy')
 def resonance_model(mass, amplitude, center, width):
     """
     Relativistic Breit-Wigner resonance shape.
@@ -98,14 +126,125 @@ def resonance_model(mass, amplitude, center, width):
     """
     return amplitude * (width**2) / ((mass**2 - center**2)**2 + (center * width)**2)
 
+@njit(fastmath=True, cache=True, nogil=True, error_model='numpy')
+def _full_model_into(mass, mass_pow, a, b, c, amp1, center1, width1,
+                     amp2, center2, width2, out):
+    """
+    Evaluate full_model into a preallocated output buffer.
+    
+    `mass_pow` is mass**(-3.5); it is fixed during a fit, so callers
+    compute it once instead of on every evaluation. As in background_model
+    the exponent b*m is capped at 50 to keep trial steps finite.
+    """
+    cw1 = (center1 * width1)**2
+    cw2 = (center2 * width2)**2
+    for i in range(mass.shape[0]):
+        m = mass[i]
+        m2 = m * m
+        d1 = m2 - center1 * center1
+        d1 = d1 * d1 + cw1
+        d2 = m2 - center2 * center2
+        d2 = d2 * d2 + cw2
+        out[i] = (a * math.exp(-min(b * m, 50.0)) + c * mass_pow[i]
+                  + amp1 * width1 * width1 / d1
+                  + amp2 * width2 * width2 / d2)
+    return out
+
+@njit(fastmath=True, cache=True, nogil=True, error_model='numpy')
 def full_model(mass, a, b, c, amp1, center1, width1, amp2, center2, width2):
     """
     Full model: background + two resonances.
+    
+    Evaluated as a single fused loop so that each call to the model
+    (hundreds per fit) writes the output once without intermediates.
     """
-    bg = background_model(mass, a, b, c)
-    res1 = resonance_model(mass, amp1, center1, width1)
-    res2 = resonance_model(mass, amp2, center2, width2)
-    return bg + res1 + res2
+    return _full_model_into(mass, mass**(-3.5), a, b, c, amp1, center1, width1,
+                            amp2, center2, width2, np.empty(mass.shape))
+
+def make_full_model(mass):
+    """
+    Compile a full_model kernel specialised to a fixed mass grid.
+    
+    The grid-dependent terms (mass, mass**2 and mass**-3.5) are captured
+    as compile-time constants, so repeated fits on the same grid (toy
+    studies) only stream the parameters through the compiled loop.
+    
+    Returns:
+    --------
+    model_into : callable
+        model_into(a, b, c, amp1, center1, width1, amp2, center2, width2, out)
+        writes the model evaluated on `mass` into `out` and returns it;
+        its grid length is available as model_into.num_points
+    """
+    grid = np.array(mass, dtype=float)
+    grid_sq = grid * grid
+    grid_pow = grid**(-3.5)
+    n = grid.shape[0]
+    
+    @njit(fastmath=True, nogil=True, error_model='numpy')
+    def model_into(a, b, c, amp1, center1, width1, amp2, center2, width2, out):
+        # Compiled code does not bounds-check, so guard the fixed-size loop
+        if out.shape[0] != n:
+            raise ValueError("out does not match the kernel's mass grid")
+        cw1 = (center1 * width1)**2
+        cw2 = (center2 * width2)**2
+        for i in range(n):
+            d1 = grid_sq[i] - center1 * center1
+            d1 = d1 * d1 + cw1
+            d2 = grid_sq[i] - center2 * center2
+            d2 = d2 * d2 + cw2
+            out[i] = (a * math.exp(-min(b * grid[i], 50.0)) + c * grid_pow[i]
+                      + amp1 * width1 * width1 / d1
+                      + amp2 * width2 * width2 / d2)
+        return out
+    
+    model_into.num_points = n
+    return model_into
+
+@lru_cache(maxsize=8)
+def _grid_full_model(num_points):
+    """make_full_model for the standard mass grid, compiled once per size."""
+    return make_full_model(_mass_grid(num_points))
+
+def full_model_jac(mass, a, b, c, amp1, center1, width1, amp2, center2, width2,
+                   out=None, mass_pow=None, mass_sq=None):
+    """
+    Analytic Jacobian of full_model with respect to its nine parameters.
+    
+    Parameters:
+    -----------
+    out : array, optional
+        Preallocated (len(mass), 9) buffer to write the Jacobian into
+    mass_pow : array, optional
+        Precomputed mass**(-3.5)
+    mass_sq : array, optional
+        Precomputed mass**2
+    
+    Returns:
+    --------
+    jac : array, shape (len(mass), 9)
+    """
+    jac = np.empty((mass.shape[0], 9)) if out is None else out
+    
+    # Background columns
+    exp_bm = np.exp(-np.minimum(b * mass, 50.0))
+    jac[:, 0] = exp_bm
+    jac[:, 1] = -a * mass * exp_bm
+    jac[:, 2] = mass**(-3.5) if mass_pow is None else mass_pow
+    
+    # Resonance columns: d/d(amplitude, center, width) of amp*w^2/denom
+    m2 = mass * mass if mass_sq is None else mass_sq
+    for col, amp, center, width in ((3, amp1, center1, width1),
+                                    (6, amp2, center2, width2)):
+        m2mc2 = m2 - center**2
+        cw = center * width
+        denom = m2mc2**2 + cw**2
+        shape = width**2 / denom
+        jac[:, col] = shape
+        jac[:, col + 1] = -amp * shape * (2 * center * width**2 - 4 * center * m2mc2) / denom
+        jac[:, col + 2] = 2 * amp * width / denom * (1 - cw**2 / denom)
+    
+    return jac
 
 # ============================================================================
 # DATA SIMULATION (REPLACE WITH REAL LHC DATA)
@@ -116,11 +255,14 @@ def simulate_lhc_data(num_points=1000, seed=42):
     Simulate LHC dijet data with predicted resonances.
     
     In real analysis, replace this with CMS/ATLAS Open Data.
+    
+    `seed` may be an int or a np.random.SeedSequence (as used for toys).
     """
-    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
     
     # Mass range: 1.5 TeV to 4.0 TeV
-    mass = np.linspace(1500, 4000, num_points)
+    mass = _mass_grid(num_points)
+    dm = (mass[-1] - mass[0]) / (num_points - 1)
     
     # Background parameters (typical for dijet spectra)
     a, b, c = 1e6, 0.0015, 1e8
@@ -133,13 +275,13 @@ def simulate_lhc_data(num_points=1000, seed=42):
     
     # Resonance 1: M_coh = 2.3 TeV
     res1 = resonance_model(mass, 
-                          amplitude=0.05 * bg[np.abs(mass - 2300).argmin()],
+                          amplitude=0.05 * bg[_nearest_index(mass[0], dm, 2300, num_points)],
                           center=2300.0,
                           width=50.0)
     
     # Resonance 2: M_κ = 3.1 TeV
     res2 = resonance_model(mass,
-                          amplitude=0.03 * bg[np.abs(mass - 3100).argmin()],
+                          amplitude=0.03 * bg[_nearest_index(mass[0], dm, 3100, num_points)],
                           center=3100.0,
                           width=60.0)
     
@@ -147,11 +289,10 @@ def simulate_lhc_data(num_points=1000, seed=42):
     expected = bg + res1 + res2
     
     # Poisson fluctuations
-    data = np.random.poisson(expected)
+    data = rng.poisson(expected)
     
-    # Statistical uncertainties
-    errors = np.sqrt(data)
-    errors[errors == 0] = 1.0  # Avoid division by zero
+    # Statistical uncertainties (empty bins get 1 to avoid division by zero)
+    errors = np.sqrt(np.maximum(data, 1.0))
     
     return mass, data, errors, bg, res1 + res2
 
@@ -159,14 +300,43 @@ def simulate_lhc_data(num_points=1000, seed=42):
 # ANALYSIS FUNCTIONS
 # ============================================================================
 
-def fit_resonances(mass, data, errors):
+def _pcov_from_jac(jac, cost, num_points):
+    """
+    Parameter covariance from the weighted Jacobian at the optimum.
+    
+    Mirrors curve_fit: pinv(J^T J) via SVD, scaled by the reduced chi^2.
+    """
+    _, s, VT = np.linalg.svd(jac, full_matrices=False)
+    threshold = np.finfo(float).eps * max(jac.shape) * s[0]
+    s = s[s > threshold]
+    VT = VT[:s.size]
+    pcov = np.dot(VT.T / s**2, VT)
+    
+    dof = num_points - jac.shape[1]
+    if dof > 0:
+        pcov *= 2 * cost / dof
+    else:
+        pcov.fill(np.inf)
+    return pcov
+
+def fit_resonances(mass, data, errors, model_into=None):
     """
     Fit the data to search for resonances.
     
+    Parameters:
+    -----------
+    model_into : callable, optional
+        Grid-specialised kernel from make_full_model(mass); by default the
+        generic full_model kernel is used
+    
     Returns:
     --------
     result : dict with fit parameters and significance
     """
+    if model_into is not None and model_into.num_points != len(mass):
+        raise ValueError(f"model_into was compiled for {model_into.num_points} mass points, "
+                         f"got {len(mass)}")
+    
     # Initial parameter guesses
     # [a, b, c, amp1, center1, width1, amp2, center2, width2]
     p0 = [1e6, 0.0015, 1e8,  # background
@@ -177,10 +347,44 @@ def fit_resonances(mass, data, errors):
     bounds = ([1e5, 0.0005, 1e7, 0, 2200, 20, 0, 3000, 30],
               [1e7, 0.003, 1e9, 1e6, 2400, 100, 1e6, 3200, 100])
     
+    # Scratch buffers reused by every model and Jacobian evaluation of the
+    # fit; mass is fixed, so its power-law term and square (shared by
+    # both resonances) are computed only once
+    model_buf = np.empty(mass.shape)
+    jac_buf = np.empty((len(mass), 9))
+    mass_pow = mass**(-3.5)
+    mass_sq = mass * mass
+    
+    inv_err = 1.0 / errors
+    
+    if model_into is None:
+        def model(params):
+            return _full_model_into(mass, mass_pow, *params, model_buf)
+    else:
+        def model(params):
+            return model_into(*params, model_buf)
+    
+    # Error-weighted residuals and their Jacobian
+    def residuals(params):
+        return (model(params) - data) * inv_err
+    
+    def residuals_jac(params):
+        jac = full_model_jac(mass, *params, out=jac_buf,
+                             mass_pow=mass_pow, mass_sq=mass_sq)
+        jac *= inv_err[:, np.newaxis]
+        return jac
+    
     try:
-        # Perform fit
-        popt, pcov = curve_fit(full_model, mass, data, p0=p0, 
-                              sigma=errors, bounds=bounds, maxfev=5000)
+        # Perform fit; x_scale='jac' rescales the very differently sized
+        # parameters by the Jacobian column norms. Default tolerances:
+        # loosened ftol/xtol stop this fit before the amplitudes converge
+        result = least_squares(residuals, p0, jac=residuals_jac, bounds=bounds,
+                               method='trf', x_scale='jac', max_nfev=5000)
+        if not result.success:
+            raise RuntimeError(f"Optimal parameters not found: {result.message}")
+        
+        popt = result.x
+        pcov = _pcov_from_jac(result.jac, result.cost, len(data))
         
         # Calculate uncertainties
         perr = np.sqrt(np.diag(pcov))
@@ -211,28 +415,98 @@ def calculate_significance_local(data, bg, window=100):
     """
     Calculate local significance around predicted masses.
     """
-    significances = {}
+    # Window edges of all predictions located on the sorted mass grid at once
+    mass_bins = _mass_grid(len(data))
+    centers = PREDICTIONS_ARR["center"]
     
-    for name, pred in PREDICTIONS.items():
-        center = pred["center"]
-        # Find mass bin closest to predicted center
-        mass_bins = np.linspace(1500, 4000, len(data))
-        idx = np.abs(mass_bins - center).argmin()
-        
-        # Define signal region (± window GeV around prediction)
-        mask = (mass_bins > center - window) & (mass_bins < center + window)
-        
-        # Calculate signal and background in signal region
-        signal_sum = np.sum(data[mask] - bg[mask])
-        bg_sum = np.sum(bg[mask])
-        
-        if bg_sum > 0:
-            significance = signal_sum / np.sqrt(bg_sum)
-            significances[name] = significance
-        else:
-            significances[name] = 0.0
+    # Define signal regions (± window GeV around each prediction, edges
+    # excluded): bins lo .. hi-1 satisfy center-window < mass < center+window
+    lo = np.searchsorted(mass_bins, centers - window, side='right')
+    hi = np.searchsorted(mass_bins, centers + window, side='left')
+    
+    # Calculate signal and background in signal regions from prefix sums
+    cum_d = np.concatenate(([0.0], np.cumsum(data)))
+    cum_b = np.concatenate(([0.0], np.cumsum(bg)))
+    bg_sum = cum_b[hi] - cum_b[lo]
+    signal_sum = cum_d[hi] - cum_d[lo] - bg_sum
     
-    return significances
+    valid = bg_sum > 0
+    significance = np.where(valid, signal_sum / np.sqrt(np.where(valid, bg_sum, 1.0)), 0.0)
+    
+    return {str(name): sig for name, sig in zip(PREDICTIONS_ARR["name"], significance)}
+
+def significance_scan(data, bg, window=100):
+    """
+    Scan local significance over the full mass range.
+    
+    The window (± window GeV) is slid over every bin of the uniform
+    1.5-4.0 TeV grid. Window sums are differences of cumulative sums, so
+    the full scan is a single O(N) pass.
+    
+    Returns:
+    --------
+    significance : array
+        Local significance per mass bin (NaN where the window would
+        extend beyond the spectrum)
+    """
+    n = len(data)
+    significance = np.full(n, np.nan)
+    if n < 2:
+        return significance
+    
+    # Bins strictly inside the window on each side of the center, with the
+    # same excluded edges as calculate_significance_local
+    mass_bins = _mass_grid(n)
+    w_bins = int(np.searchsorted(mass_bins, mass_bins[0] + window, side='left')) - 1
+    if n <= 2 * w_bins:
+        return significance
+    
+    cum_d = np.concatenate(([0.0], np.cumsum(data)))
+    cum_b = np.concatenate(([0.0], np.cumsum(bg)))
+    
+    # Bins i - w_bins .. i + w_bins for every center i where that fits
+    lo = np.arange(n - 2 * w_bins)
+    hi = lo + 2 * w_bins + 1
+    bg_sum = cum_b[hi] - cum_b[lo]
+    signal_sum = cum_d[hi] - cum_d[lo] - bg_sum
+    
+    valid = bg_sum > 0
+    significance[w_bins:n - w_bins] = np.where(
+        valid, signal_sum / np.sqrt(np.where(valid, bg_sum, 1.0)), 0.0)
+    
+    return significance
+
+def run_toy_fits(n_toys, base_seed=0, num_points=1000, max_workers=None):
+    """
+    Fit independent toy datasets in parallel for significance calibration.
+    
+    Each toy gets its own random stream spawned from `base_seed`, so the
+    result does not depend on the number of worker threads. The model
+    kernel is specialised to the toy mass grid and releases the GIL,
+    letting fits overlap across threads.
+    
+    Returns:
+    --------
+    significances : array, shape (n_toys, 2)
+        amp/amp_err for both resonances per toy (NaN where the fit failed)
+    """
+    seeds = np.random.SeedSequence(base_seed).spawn(n_toys)
+    
+    # All toys share the mass grid, so one specialised kernel serves them all
+    model_into = _grid_full_model(num_points)
+    
+    def run_one(seed):
+        mass, data, errors, bg, signal = simulate_lhc_data(num_points, seed=seed)
+        fit = fit_resonances(mass, data, errors, model_into=model_into)
+        if not fit["success"]:
+            return np.full(2, np.nan)
+        amp_idx = [3, 6]
+        return fit["parameters"][amp_idx] / fit["uncertainties"][amp_idx]
+    
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        significances = np.array(list(pool.map(run_one, seeds)))
+    
+    return significances.reshape(n_toys, 2)
 
 # ============================================================================
 # VISUALIZATION
@@ -242,8 +516,14 @@ def plot_analysis(mass, data, errors, bg, signal, fit_result=None):
     """
     Create comprehensive analysis plot.
     """
+    import matplotlib.pyplot as plt
+    
     fig, axes = plt.subplots(2, 2, figsize=(14, 10))
     
+    # Background-subtracted data, shared by plots 2 and 3
+    bg_subtracted = data - bg
+    bg_subtracted_err = np.sqrt(data + bg)  # Approximate error
+    
     # Plot 1: Data with background
     axes[0, 0].errorbar(mass, data, yerr=errors, fmt='.', color='black', 
                        alpha=0.5, label='Simulated Data', markersize=2)
@@ -256,9 +536,6 @@ def plot_analysis(mass, data, errors, bg, signal, fit_result=None):
     axes[0, 0].legend()
     
     # Plot 2: Background-subtracted data
-    bg_subtracted = data - bg
-    bg_subtracted_err = np.sqrt(data + bg)  # Approximate error
-    
     axes[0, 1].errorbar(mass, bg_subtracted, yerr=bg_subtracted_err, 
                        fmt='.', color='blue', alpha=0.5, markersize=2)
     axes[0, 1].axhline(y=0, color='red', linestyle='--')
@@ -277,10 +554,12 @@ def plot_analysis(mass, data, errors, bg, signal, fit_result=None):
     
     # Plot 3: Signal region zoom
     zoom_min, zoom_max = 2200, 3400
-    zoom_mask = (mass > zoom_min) & (mass < zoom_max)
+    # mass is sorted; bins lo .. hi-1 satisfy zoom_min < mass < zoom_max
+    lo = np.searchsorted(mass, zoom_min, side='right')
+    hi = np.searchsorted(mass, zoom_max, side='left')
     
-    axes[1, 0].errorbar(mass[zoom_mask], bg_subtracted[zoom_mask], 
-                       yerr=bg_subtracted_err[zoom_mask], 
+    axes[1, 0].errorbar(mass[lo:hi], bg_subtracted[lo:hi], 
+                       yerr=bg_subtracted_err[lo:hi], 
                        fmt='.', color='blue', alpha=0.7, markersize=3)
     axes[1, 0].axhline(y=0, color='red', linestyle='--')
     
@@ -365,6 +644,11 @@ def main():
     
     # Step 4: Create visualization
     print("\n4. Generating plots...")
+    # Render off-screen unless the plot window was requested, so headless
+    # batch runs never probe for a GUI backend
+    if not os.environ.get('SHOW_PLOTS'):
+        import matplotlib
+        matplotlib.use('Agg')
     fig = plot_analysis(mass, data, errors, bg, signal, fit_result)
     
     # Save results
@@ -375,13 +659,11 @@ def main():
     output_files.append('dijet_analysis_results.png')
     print(f"   • Saved plot: dijet_analysis_results.png")
     
-    # Save data to text file
-    np.savetxt('dijet_data.txt', 
-              np.column_stack([mass, data, errors, bg]),
-              header='mass[GeV] data errors background',
-              fmt='%.1f %.1f %.1f %.1f')
-    output_files.append('dijet_data.txt')
-    print(f"   • Saved data: dijet_data.txt")
+    # Save data (compressed binary, one named array per column)
+    np.savez_compressed('dijet_data.npz',
+                        mass=mass, data=data, errors=errors, background=bg)
+    output_files.append('dijet_data.npz')
+    print(f"   • Saved data: dijet_data.npz")
     
     # Save fit results
     if fit_result["success"]:
@@ -408,11 +690,10 @@ def main():
     print(f"Generated files: {', '.join(output_files)}")
     print("=" * 70)
     
-    # Show plot (if running interactively)
-    try:
+    # Show plot (set SHOW_PLOTS=1 when running interactively)
+    if os.environ.get('SHOW_PLOTS'):
+        import matplotlib.pyplot as plt
         plt.show()
-    except:
-        pass  # Running in non-interactive mode
     
     return fit_result
 
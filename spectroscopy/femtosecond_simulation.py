@@ -11,10 +11,12 @@ Author: UnifiedTheoryPredictions
 Repository: https://github.com/UnifiedTheoryPredictions/unified-theory-experimental
 """
 
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.optimize import curve_fit
 from scipy.signal import find_peaks
+from scipy.special import erf
+from numba import njit
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -52,6 +54,20 @@ def correlation_function(time, A, t0, sigma, background):
     """
     return A * np.exp(-(time - t0)**2 / (2*sigma**2)) + background
 
+def correlation_jac(time, A, t0, sigma, background):
+    """
+    Analytic Jacobian of correlation_function with respect to
+    (A, t0, sigma, background).
+    """
+    u = (time - t0) / sigma
+    gauss = np.exp(-u**2 / 2)
+    jac = np.empty((time.shape[0], 4))
+    jac[:, 0] = gauss
+    jac[:, 1] = A * u * gauss / sigma
+    jac[:, 2] = A * u**2 * gauss / sigma
+    jac[:, 3] = 1.0
+    return jac
+
 def instrument_response(t, t0, width):
     """Instrument response function (laser pulse)."""
     return np.exp(-(t - t0)**2 / (2*width**2))
@@ -88,12 +104,29 @@ def generate_correlation_data(num_points=1000, laser_width=50e-15, noise_level=0
     sigma = PREDICTION["width"] / 2.355  # Convert FWHM to sigma
     background = 0.1
     
-    ideal_correlation = correlation_function(time_delay, A, t0_val, sigma, background)
-    
-    # Convolve with instrument response
-    from scipy.signal import convolve
-    instrument = instrument_response(time_delay, 0, laser_width)
-    correlation = convolve(ideal_correlation, instrument, mode='same') / np.sum(instrument)
+    # Convolve with instrument response. Both terms are Gaussian, so the
+    # convolution over the finite delay window (the laser pulse is sampled
+    # on the same ±time_range axis) is evaluated in closed form
+    lower = np.maximum(-time_range, time_delay - time_range)
+    upper = np.minimum(time_range, time_delay + time_range)
+    sqrt2 = np.sqrt(2)
+    instrument_area = laser_width * np.sqrt(2*np.pi) * erf(time_range / (laser_width*sqrt2))
+    
+    # Constant background seen through the truncated laser pulse
+    bg_part = background * laser_width * np.sqrt(np.pi/2) * (
+        erf((time_delay - lower) / (laser_width*sqrt2))
+        - erf((time_delay - upper) / (laser_width*sqrt2)))
+    
+    # Gaussian correlation: product of two Gaussians integrated over the window
+    sigma_eff2 = sigma**2 + laser_width**2
+    sigma_prod = sigma * laser_width / np.sqrt(sigma_eff2)
+    mu = (t0_val * laser_width**2 + time_delay * sigma**2) / sigma_eff2
+    peak_part = A * np.exp(-(time_delay - t0_val)**2 / (2*sigma_eff2)) \
+        * sigma_prod * np.sqrt(np.pi/2) * (
+            erf((upper - mu) / (sigma_prod*sqrt2))
+            - erf((lower - mu) / (sigma_prod*sqrt2)))
+    
+    correlation = (peak_part + bg_part) / instrument_area
     
     # Normalize
     correlation = correlation / np.max(correlation)
@@ -112,6 +145,22 @@ def generate_correlation_data(num_points=1000, laser_width=50e-15, noise_level=0
 # ANALYSIS FUNCTIONS
 # ============================================================================
 
+@njit(cache=True, nogil=True)
+def _fwhm_crossings(signal, peak_idx, half_max):
+    """
+    Walk outward from the peak to the first samples below half maximum.
+    
+    Returns (left, right) indices; left is -1 or right is len(signal)
+    if the signal never drops below half_max on that side.
+    """
+    i = peak_idx - 1
+    while i >= 0 and signal[i] >= half_max:
+        i -= 1
+    j = peak_idx + 1
+    while j < signal.shape[0] and signal[j] >= half_max:
+        j += 1
+    return i, j
+
 def find_correlation_peak(time, signal, height_threshold=0.5):
     """
     Find the correlation peak and measure its parameters.
@@ -134,18 +183,11 @@ def find_correlation_peak(time, signal, height_threshold=0.5):
     
     # Estimate width (FWHM)
     half_max = peak_amplitude / 2
-    # Find left half-max point
-    left_side = signal[:main_peak_idx]
-    left_indices = np.where(left_side < half_max)[0]
-    
-    # Find right half-max point
-    right_side = signal[main_peak_idx:]
-    right_indices = np.where(right_side < half_max)[0]
-    
-    if len(left_indices) > 0 and len(right_indices) > 0:
-        left_time = time[left_indices[-1]]
-        right_time = time[main_peak_idx + right_indices[0]]
-        fwhm = right_time - left_time
+    # Find left and right half-max points
+    left_idx, right_idx = _fwhm_crossings(signal, main_peak_idx, half_max)
+    
+    if left_idx >= 0 and right_idx < len(signal):
+        fwhm = time[right_idx] - time[left_idx]
     else:
         fwhm = PREDICTION["width"]  # Use theoretical if can't measure
     
@@ -173,8 +215,11 @@ def fit_correlation(time, signal, noise):
     upper_bounds = [2*A_guess, 10e-15, 5e-15, 0.5]
     
     try:
+        # Default tolerances: t0 and sigma are ~1e-15 s next to an O(1)
+        # amplitude, and loosened ftol/xtol stop the solver before t0 settles
         popt, pcov = curve_fit(correlation_function, time, signal, p0=p0,
-                              sigma=noise, bounds=(lower_bounds, upper_bounds))
+                              sigma=noise, bounds=(lower_bounds, upper_bounds),
+                              jac=correlation_jac, check_finite=False)
         
         perr = np.sqrt(np.diag(pcov))
         
@@ -201,6 +246,8 @@ def plot_correlation_analysis(time, signal, noise, peak_info=None, fit_result=No
     """
     Create comprehensive correlation analysis plot.
     """
+    import matplotlib.pyplot as plt
+    
     fig, axes = plt.subplots(2, 2, figsize=(14, 10))
     
     # Convert time to femtoseconds for plotting
@@ -361,6 +408,11 @@ def main():
     
     # Step 4: Create visualization
     print("\n4. Generating plots...")
+    # Render off-screen unless the plot window was requested, so headless
+    # batch runs never probe for a GUI backend
+    if not os.environ.get('SHOW_PLOTS'):
+        import matplotlib
+        matplotlib.use('Agg')
     fig = plot_correlation_analysis(time, correlation, noise, peak_info, fit_result)
     
     # Save results
@@ -371,40 +423,49 @@ def main():
     output_files.append('femtosecond_correlation_results.png')
     print(f"   • Saved plot: femtosecond_correlation_results.png")
     
-    # Save data
+    # Save data: binary .npz for downstream analysis, text for inspection
+    np.savez_compressed('femtosecond_data.npz',
+                        time=time, correlation=correlation, noise=noise)
+    output_files.append('femtosecond_data.npz')
+    print(f"   • Saved data: femtosecond_data.npz")
+    
     np.savetxt('femtosecond_data.txt',
-              np.column_stack([time, correlation, noise]),
+              np.vstack((time, correlation, noise)).T,
               header='time[s] correlation noise',
-              fmt='%.6e %.6e %.6e')
+              fmt='%.6g')
     output_files.append('femtosecond_data.txt')
     print(f"   • Saved data: femtosecond_data.txt")
     
-    # Save analysis results
+    # Save analysis results (assembled first, written in one call)
+    report = [
+        "FEMTOSECOND CORRELATION ANALYSIS\n"
+        "=================================\n\n"
+        "THEORY PREDICTION:\n"
+        f"t = {PREDICTION['t']} s ({PREDICTION['t']*1e15:.1f} fs)\n"
+        f"Uncertainty: ± {PREDICTION['uncertainty']} s (± {PREDICTION['uncertainty']*1e15:.1f} fs)\n\n"
+    ]
+    
+    if peak_info:
+        diff = peak_info['time'] - PREDICTION['t']
+        report.append(
+            "DETECTED PEAK:\n"
+            f"Time: {peak_info['time']} s ({peak_info['time']*1e15:.1f} fs)\n"
+            f"Amplitude: {peak_info['amplitude']:.3f}\n"
+            f"FWHM: {peak_info['fwhm']} s ({peak_info['fwhm']*1e15:.1f} fs)\n\n"
+            "DIFF FROM PREDICTION:\n"
+            f"dt = {diff} s ({diff*1e15:.1f} fs)\n"
+            f"Relative: {abs(diff)/PREDICTION['t']*100:.1f}%\n\n")
+    
+    if fit_result["success"]:
+        report.append(
+            "FIT RESULTS:\n"
+            f"t = {fit_result['t0']:.2e} s ({fit_result['t0']*1e15:.1f} fs)\n"
+            f"t error = {fit_result['t0_error']:.2e} s ({fit_result['t0_error']*1e15:.1f} fs)\n"
+            f"FWHM = {fit_result['fwhm']:.2e} s ({fit_result['fwhm']*1e15:.1f} fs)\n"
+            f"Amplitude = {fit_result['amplitude']:.3f} ± {fit_result['amplitude_error']:.3f}\n")
+    
     with open('femtosecond_analysis_results.txt', 'w', encoding='utf-8') as f:
-        f.write("FEMTOSECOND CORRELATION ANALYSIS\n")
-        f.write("=================================\n\n")
-        
-        f.write("THEORY PREDICTION:\n")
-        f.write(f"t = {PREDICTION['t']} s ({PREDICTION['t']*1e15:.1f} fs)\n")
-        f.write(f"Uncertainty: ± {PREDICTION['uncertainty']} s (± {PREDICTION['uncertainty']*1e15:.1f} fs)\n\n")
-        
-        if peak_info:
-            f.write("DETECTED PEAK:\n")
-            f.write(f"Time: {peak_info['time']} s ({peak_info['time']*1e15:.1f} fs)\n")
-            f.write(f"Amplitude: {peak_info['amplitude']:.3f}\n")
-            f.write(f"FWHM: {peak_info['fwhm']} s ({peak_info['fwhm']*1e15:.1f} fs)\n\n")
-            
-            diff = peak_info['time'] - PREDICTION['t']
-            f.write(f"DIFF FROM PREDICTION:\n")
-            f.write(f"dt = {diff} s ({diff*1e15:.1f} fs)\n")
-            f.write(f"Relative: {abs(diff)/PREDICTION['t']*100:.1f}%\n\n")
-        
-        if fit_result["success"]:
-            f.write("FIT RESULTS:\n")
-            f.write(f"t = {fit_result['t0']:.2e} s ({fit_result['t0']*1e15:.1f} fs)\n")
-            f.write(f"t error = {fit_result['t0_error']:.2e} s ({fit_result['t0_error']*1e15:.1f} fs)\n")
-            f.write(f"FWHM = {fit_result['fwhm']:.2e} s ({fit_result['fwhm']*1e15:.1f} fs)\n")
-            f.write(f"Amplitude = {fit_result['amplitude']:.3f} ± {fit_result['amplitude_error']:.3f}\n")
+        f.write("".join(report))
     
     output_files.append('femtosecond_analysis_results.txt')
     print(f"   • Saved analysis: femtosecond_analysis_results.txt")
@@ -414,11 +475,10 @@ def main():
     print(f"Generated files: {', '.join(output_files)}")
     print("=" * 70)
     
-    # Show plot (optional)
-    try:
+    # Show plot (set SHOW_PLOTS=1 when running interactively)
+    if os.environ.get('SHOW_PLOTS'):
+        import matplotlib.pyplot as plt
         plt.show()
-    except:
-        pass  # Non-interactive mode
     
     return fit_result
 